@@ -1,10 +1,9 @@
 # bot.py
 import asyncio
 import json
-import os
-from typing import Any, Awaitable, Dict, List, Optional, Tuple, Union
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
 
-import aiofiles
 import numpy as np
 from aiogoogle import Aiogoogle
 from aiogoogle.models import HTTPError as AiogoogleHttpError
@@ -12,6 +11,22 @@ from dependency_injector.wiring import Provide, inject
 from discord.ext import commands
 
 from app_config import AppConfigContainer
+from check_expression import (
+    AbilityCell,
+    CheckExpressionError,
+    bind_macros,
+    build_check_expression,
+    format_check,
+    resolve_ability,
+    split_check_args,
+)
+from claims import (
+    invalidate_macros,
+    read_claim,
+    read_macros,
+    write_claim,
+    write_macros,
+)
 
 bot = commands.Bot(command_prefix="!")
 
@@ -21,31 +36,15 @@ class SheetNotFoundError(Exception):
         super().__init__(f"Sheet with title '{sheet_title}' not found!")
 
 
-async def get_ability_by_name(
-    aiog: Aiogoogle,
-    sheets_service: Any,
-    doc_id: str,
-    sheet_title: str,
-    ability_name: str,
-    lowercast: bool = True,
-) -> List[Tuple[str, int]]:
-    req = sheets_service.spreadsheets.values.get(
-        spreadsheetId=doc_id, range=sheet_title  # is doc_id required here?
+async def get_ability_cells(
+    aiog: Aiogoogle, sheets_service: Any, doc_id: str, sheet_title: str
+) -> List[AbilityCell]:
+    req = sheets_service.spreadsheets.values.batchGet(
+        spreadsheetId=doc_id,
+        ranges=[f"{sheet_title}!A:A", f"{sheet_title}!G:G"],
     )
-    if lowercast:
-        req.url = (
-            f"https://docs.google.com/spreadsheets/d/{doc_id}/gviz/tq"
-            f"?tq=select+A+,+G+where+lower(A)+contains+'{ability_name.lower()}'"
-            f"+limit+3&sheet={sheet_title}&tqx=out:csv"
-        )
-    else:
-        req.url = (
-            f"https://docs.google.com/spreadsheets/d/{doc_id}/gviz/tq"
-            f"?tq=select+A+,+G+where+A+contains+'{ability_name}'"
-            f"+limit+3&sheet={sheet_title}&tqx=out:csv"
-        )
     try:
-        res_csv = await aiog.as_service_account(
+        res = await aiog.as_service_account(
             req,
         )
     except AiogoogleHttpError as e:
@@ -53,56 +52,18 @@ async def get_ability_by_name(
             raise SheetNotFoundError(sheet_title)
         else:
             raise e
-
-    # extract all names and values from the csv response
-    name_value_pairs = []
-    for line in res_csv.split("\n"):
-        if len(line) == 0:
-            continue
-        name, value = line.replace('"', "").split(",")  # remove all "" and split at ,
-        value = int(value)
-        name_value_pairs.append((name, value))
-    return name_value_pairs
-
-
-@inject
-async def write_claim(
-    guild_id: int,
-    author_id: int,
-    sheet_title: str,
-    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
-) -> None:
-    guild_dir_path = os.path.join(claims_dir, str(guild_id))
-    # TODO use the below as soon as aiofiles v0.8.0 gets released
-    # await aiofiles.os.makedirs(guild_dir_path, exist_ok=True)
-    # For now use the following workaround to create the dirs
-    try:
-        await aiofiles.os.mkdir(claims_dir)  # type: ignore[attr-defined]
-    except FileExistsError:
-        pass
-    try:
-        await aiofiles.os.mkdir(guild_dir_path)  # type: ignore[attr-defined]
-    except FileExistsError:
-        pass
-    # Create the claim file
-    author_file_path = os.path.join(guild_dir_path, str(author_id))
-    async with aiofiles.open(author_file_path, "w") as f:
-        await f.write(sheet_title)
-
-
-@inject
-async def read_claim(
-    guild_id: int,
-    author_id: int,
-    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
-) -> Optional[str]:
-    author_file_path = os.path.join(claims_dir, str(guild_id), str(author_id))
-    try:
-        async with aiofiles.open(author_file_path, "r") as f:
-            sheet_title = await f.read()
-        return sheet_title
-    except FileNotFoundError:
-        return None
+    keys = res["valueRanges"][0].get("values", [])
+    vals = res["valueRanges"][1].get("values", [])
+    # Google Sheets API cuts off empty cells in the end of a range
+    # Fill them up again in the vals so that the zip below works
+    if len(vals) < len(keys):
+        vals += [[]] * (len(keys) - len(vals))
+    cells: List[AbilityCell] = []
+    for row, (_key, _val) in enumerate(zip(keys, vals), start=1):
+        if len(_key) and _key[0]:
+            value = parse_int(_val[0]) if len(_val) else None
+            cells.append((_key[0], row, value))
+    return cells
 
 
 async def get_sheets_properties(
@@ -316,6 +277,9 @@ async def migrate(
             req,
         )
 
+        # The rows and values of the sheet changed, so macros bound to it are stale
+        await invalidate_macros(ctx.message.guild.id, curr_sheet_title)
+
         return await ctx.send(
             f"Successfully migrated sheet {curr_sheet_title}."
             f"The old sheet can be found in {old_sheet_title}"
@@ -357,6 +321,11 @@ async def claim(
     guild_id = ctx.message.guild.id
     author_id = ctx.message.author.id
     await write_claim(guild_id, author_id, sheet_title)
+    # Claiming again works as refresh, so let the next !m bind the macros again
+    macros = await read_macros(guild_id, author_id)
+    if macros is not None:
+        macros["sheet_title"] = None
+        await write_macros(guild_id, author_id, macros)
     return await ctx.send(
         f"{ctx.message.author} claimed the sheet with title {sheet_title}"
     )
@@ -444,7 +413,14 @@ async def check_impl(
     ],
     aiog: Aiogoogle = Provide[AppConfigContainer.aiog],
 ) -> Any:
-    expression: List[Union[Tuple[str, int], str]] = []
+    try:
+        names, seps = split_check_args(args, ctx.message.content)
+    except CheckExpressionError as e:
+        return await ctx.send(str(e))
+    if len(names) == 0:
+        return await ctx.send("Nothing to roll!")
+
+    name_value_pairs: List[Tuple[str, int]] = []
     async with aiog:
         sheets_service = await aiog.discover("sheets", "v4")
         # First make sure that the character_name belongs to a valid sheet
@@ -457,103 +433,25 @@ async def check_impl(
                 f"ERROR: character name '{character_name}' does not correspond to a valid"
                 " sheet in the configured character document!"
             )
+        cells = await get_ability_cells(
+            aiog, sheets_service, character_sheet_hash, character_name
+        )
 
-        for idx, arg in enumerate(args):
-            if idx % 2 == 0:
-                # Try to extract ability name and value
-                name = arg
-                # First try to find results with lowercasting the name
-                name_value_pairs = await get_ability_by_name(
-                    aiog,
-                    sheets_service,
-                    character_sheet_hash,
-                    character_name,
-                    name,
-                    lowercast=False,
-                )
-                if len(name_value_pairs) == 0:
-                    # No results found, try again with lowercasting
-                    name_value_pairs = await get_ability_by_name(
-                        aiog,
-                        sheets_service,
-                        character_sheet_hash,
-                        character_name,
-                        name,
-                        lowercast=True,
-                    )
-                    if len(name_value_pairs) == 0:
-                        # Still no result, now it is a hard error
-                        return await ctx.send(f"ERROR: No ability matches '{name}'")
-                if len(name_value_pairs) > 1:
-                    return await ctx.send(
-                        f"ERROR: Multiple abilities ({[it[0] for it in name_value_pairs]} ...)"
-                        f" match '{name}'. Please be more specific,"
-                        " e.g. by typing more out or using correct uppercase."
-                    )
-                name, value = name_value_pairs[0]
-                value = int(value)
-                expression.append((name, value))
-            else:
-                # Try to extract seperator
-                sep = arg
-                if sep == "+" or sep == "-":
-                    expression.append(sep)
-                else:
-                    response = (
-                        f"ERROR: {sep} is an invalid seperator."
-                        " Valid seperators are '+' or '-'"
-                    )
-                    return await ctx.send(response)
-
-                if idx == len(args) - 1:
-                    response = "ERROR: expression {} ends with a seperator!".format(
-                        ctx.message.content
-                    )
-                    return await ctx.send(response)
+    # The sheet was read anyway, so refresh the macros bound to it for free
+    await refresh_claimed_macros(
+        ctx.message.guild.id, ctx.message.author.id, character_name, cells
+    )
 
-    if len(expression) == 0:
-        return await ctx.send("Nothing to roll!")
+    for name in names:
+        try:
+            ability_name, _, value = resolve_ability(cells, name)
+        except CheckExpressionError as e:
+            return await ctx.send(str(e))
+        name_value_pairs.append((ability_name, value))
 
     # Happy path
-    plus = np.random.randint(1, 5)
-    minus = np.random.randint(1, 5)
-
-    if len(expression) == 1:
-        assert isinstance(expression[0], tuple)
-        name, value = expression[0]
-        response = (
-            f"**{character_name}** rolls 2 x {name} + d4 - d4 = "
-            f"{2*value} + {plus} - {minus} = **{2*value + plus - minus}**"
-        )
-    else:
-        response_first = ""
-        response_second = ""
-        result = plus - minus
-        sep = "+"
-        for idx, name_value_or_sep in enumerate(expression):
-            if idx % 2 == 0:
-                # name, value pair
-                assert isinstance(name_value_or_sep, tuple)
-                (name, value) = name_value_or_sep
-                response_first += name
-                response_second += "{}".format(value)
-                if sep == "+":
-                    result += value
-                else:
-                    result -= value
-            else:
-                # seperator
-                assert isinstance(name_value_or_sep, str)
-                sep = name_value_or_sep
-
-                response_first += " {} ".format(sep)
-                response_second += " {} ".format(sep)
-
-        response = (
-            f"**{character_name}** rolls {response_first} + d4 - d4 = "
-            f"{response_second} + {plus} - {minus} = **{result}**"
-        )
-    await ctx.send(response)
+    expression = build_check_expression(name_value_pairs, seps)
+    await ctx.send(format_check(character_name, expression))
 
 
 @bot.command(name="check", help="Roll a value on your character sheet")
@@ -582,6 +480,168 @@ async def check_character(ctx: commands.Context, *args: str) -> Any:
     return await check_impl(ctx, character_name, *args)
 
 
+@inject
+async def rebind_macros(
+    character_name: str,
+    macros: Dict[str, Any],
+    character_sheet_hash: str = Provide[
+        AppConfigContainer.config.gapi.character_sheet_hash
+    ],
+    aiog: Aiogoogle = Provide[AppConfigContainer.aiog],
+) -> Dict[str, str]:
+    async with aiog:
+        sheets_service = await aiog.discover("sheets", "v4")
+        cells = await get_ability_cells(
+            aiog, sheets_service, character_sheet_hash, character_name
+        )
+    return bind_macros(macros, character_name, cells, time.time())
+
+
+async def refresh_claimed_macros(
+    guild_id: int, author_id: int, character_name: str, cells: List[AbilityCell]
+) -> None:
+    # Refresh the macros of the author with a sheet that was read anyway,
+    # as long as it is the claimed one
+    if await read_claim(guild_id, author_id) != character_name:
+        return
+    macros = await read_macros(guild_id, author_id)
+    if macros is None:
+        return
+    bind_macros(macros, character_name, cells, time.time())
+    await write_macros(guild_id, author_id, macros)
+
+
+def format_unbound_macros(unbound: Dict[str, str]) -> str:
+    return (
+        f"WARNING: Macros {list(unbound.keys())} do not match the abilities"
+        " on your sheet. They are kept and bound again once they match,"
+        " e.g. after '!macro refresh'"
+    )
+
+
+@bot.command(
+    name="macro",
+    help="Save a check expression as macro with 'save (name) (expression)'"
+    " or refresh your macros after your sheet changed with 'refresh'",
+)
+async def macro(ctx: commands.Context, *args: str) -> Any:
+    if len(args) < 1 or args[0] not in ("save", "refresh"):
+        return await ctx.send(
+            "ERROR: Invalid arguments."
+            " Use '!macro save (name) (expression)' or '!macro refresh'"
+        )
+    guild_id = ctx.message.guild.id
+    author_id = ctx.message.author.id
+    character_name = await read_claim(guild_id, author_id)
+    if character_name is None:
+        return await ctx.send(
+            f"@{ctx.message.author} you have not claimed a character yet."
+            " Please do so by using the '!claim (character name)' command"
+        )
+    macros = await read_macros(guild_id, author_id)
+    if macros is None:
+        macros = {"sheet_title": character_name, "macros": {}}
+
+    macro_name: Optional[str] = None
+    if args[0] == "save":
+        if len(args) < 3:
+            return await ctx.send(
+                "ERROR: Invalid number of arguments."
+                " Please provide a macro name followed by a check expression"
+            )
+        macro_name = args[1]
+        macro_args = args[2:]
+        try:
+            split_check_args(macro_args, ctx.message.content)
+        except CheckExpressionError as e:
+            return await ctx.send(str(e))
+        macros["macros"][macro_name] = {"args": list(macro_args), "cells": []}
+    elif len(args) != 1:
+        return await ctx.send("ERROR: '!macro refresh' takes no further arguments")
+
+    try:
+        unbound = await rebind_macros(character_name, macros)
+    except SheetNotFoundError:
+        return await ctx.send(
+            f"ERROR: character name '{character_name}' does not correspond to a valid"
+            " sheet in the configured character document!"
+        )
+    if macro_name is not None and macro_name in unbound:
+        return await ctx.send(unbound[macro_name])
+    await write_macros(guild_id, author_id, macros)
+
+    if macro_name is not None:
+        response = f"{ctx.message.author} saved macro '{macro_name}'"
+    else:
+        num_bound = len(macros["macros"]) - len(unbound)
+        response = f"{ctx.message.author} refreshed {num_bound} macros"
+    if len(unbound):
+        response += f"\n{format_unbound_macros(unbound)}"
+    return await ctx.send(response)
+
+
+MACRO_STALE_HOURS = 12
+
+
+@bot.command(
+    name="m",
+    help="Roll a check macro saved with !macro save. Its values are read from your"
+    " sheet on !macro save and refresh, !check and !claim",
+)
+async def run_macro(ctx: commands.Context, *args: str) -> Any:
+    if len(args) != 1:
+        return await ctx.send(
+            "ERROR: Invalid number of arguments. Please provide exactly one macro name!"
+        )
+    macro_name = args[0]
+    guild_id = ctx.message.guild.id
+    author_id = ctx.message.author.id
+    character_name = await read_claim(guild_id, author_id)
+    if character_name is None:
+        return await ctx.send(
+            f"@{ctx.message.author} you have not claimed a character yet."
+            " Please do so by using the '!claim (character name)' command"
+        )
+    macros = await read_macros(guild_id, author_id)
+    if macros is None or macro_name not in macros["macros"]:
+        return await ctx.send(
+            f"ERROR: No macro named '{macro_name}'."
+            " Please save it first using '!macro save (name) (expression)'"
+        )
+
+    unbound: Dict[str, str] = {}
+    if macros["sheet_title"] != character_name:
+        # A different sheet got claimed or the sheet got migrated since binding,
+        # so bind the macros to it once
+        try:
+            unbound = await rebind_macros(character_name, macros)
+        except SheetNotFoundError:
+            return await ctx.send(
+                f"ERROR: character name '{character_name}' does not correspond to a valid"
+                " sheet in the configured character document!"
+            )
+        await write_macros(guild_id, author_id, macros)
+
+    saved_macro = macros["macros"][macro_name]
+    if "error" in saved_macro:
+        response = saved_macro["error"]
+    else:
+        # Happy path, only rolling and formatting of the bound values
+        name_value_pairs = [(name, value) for name, _, value in saved_macro["cells"]]
+        expression = build_check_expression(name_value_pairs, saved_macro["args"][1::2])
+        response = format_check(character_name, expression)
+        # Edits on the sheet are not noticed by the bot, so hint at old values
+        if time.time() - macros.get("bound_at", 0) > MACRO_STALE_HOURS * 60 * 60:
+            response += (
+                "\nNOTE: These values were read from your sheet more than"
+                f" {MACRO_STALE_HOURS} hours ago. Use '!macro refresh'"
+                " if you changed your sheet since"
+            )
+    if len(unbound):
+        response += f"\n{format_unbound_macros(unbound)}"
+    return await ctx.send(response)
+
+
 @inject
 def main(
     discord_bot_token: str = Provide[
@@ -599,6 +659,6 @@ async def init_resources(container: AppConfigContainer) -> Awaitable[None]:
 
 if __name__ == "__main__":
     config_container = AppConfigContainer()
-    config_container.wire(modules=[__name__])
+    config_container.wire(modules=[__name__, "claims"])
     asyncio.run(init_resources(config_container))
     main()
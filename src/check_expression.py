@@ -0,0 +1,149 @@
+# check_expression.py
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class CheckExpressionError(Exception):
+    pass
+
+
+# (ability name, row in the character sheet, value if numeric)
+AbilityCell = Tuple[str, int, Optional[int]]
+# An ability cell a macro is bound to, which always has a value
+BoundCell = Tuple[str, int, int]
+CheckExpression = List[Union[Tuple[str, int], str]]
+
+
+def resolve_ability(cells: List[AbilityCell], name: str) -> BoundCell:
+    # Match first as typed, then lowercased, like the former gviz query of !check.
+    # Rows without a value take part in the matching, so that they are ambiguous
+    matches = [cell for cell in cells if name in cell[0]]
+    if len(matches) == 0:
+        matches = [cell for cell in cells if name.lower() in cell[0].lower()]
+        if len(matches) == 0:
+            raise CheckExpressionError(f"ERROR: No ability matches '{name}'")
+    if len(matches) > 1:
+        raise CheckExpressionError(
+            f"ERROR: Multiple abilities ({[it[0] for it in matches[:3]]} ...)"
+            f" match '{name}'. Please be more specific,"
+            " e.g. by typing more out or using correct uppercase."
+        )
+    ability_name, row, value = matches[0]
+    if value is None:
+        raise CheckExpressionError(f"ERROR: Ability '{ability_name}' has no value")
+    return ability_name, row, value
+
+
+def split_check_args(
+    args: Tuple[str, ...], content: str
+) -> Tuple[List[str], List[str]]:
+    # content is the whole message, used to point out where the expression ends
+    names = list(args[0::2])
+    seps = list(args[1::2])
+    for sep in seps:
+        if sep != "+" and sep != "-":
+            raise CheckExpressionError(
+                f"ERROR: {sep} is an invalid seperator."
+                " Valid seperators are '+' or '-'"
+            )
+    if len(args) and len(seps) == len(names):
+        raise CheckExpressionError(
+            f"ERROR: expression {content} ends with a seperator!"
+        )
+    return names, seps
+
+
+def build_check_expression(
+    name_value_pairs: List[Tuple[str, int]], seps: List[str]
+) -> CheckExpression:
+    expression: CheckExpression = []
+    for idx, name_value in enumerate(name_value_pairs):
+        if idx > 0:
+            expression.append(seps[idx - 1])
+        expression.append(name_value)
+    return expression
+
+
+def format_check(character_name: str, expression: CheckExpression) -> str:
+    plus = np.random.randint(1, 5)
+    minus = np.random.randint(1, 5)
+
+    if len(expression) == 1:
+        assert isinstance(expression[0], tuple)
+        name, value = expression[0]
+        return (
+            f"**{character_name}** rolls 2 x {name} + d4 - d4 = "
+            f"{2*value} + {plus} - {minus} = **{2*value + plus - minus}**"
+        )
+
+    response_first = ""
+    response_second = ""
+    result = plus - minus
+    sep = "+"
+    for idx, name_value_or_sep in enumerate(expression):
+        if idx % 2 == 0:
+            # name, value pair
+            assert isinstance(name_value_or_sep, tuple)
+            name, value = name_value_or_sep
+            response_first += name
+            response_second += "{}".format(value)
+            if sep == "+":
+                result += value
+            else:
+                result -= value
+        else:
+            # seperator
+            assert isinstance(name_value_or_sep, str)
+            sep = name_value_or_sep
+
+            response_first += " {} ".format(sep)
+            response_second += " {} ".format(sep)
+
+    return (
+        f"**{character_name}** rolls {response_first} + d4 - d4 = "
+        f"{response_second} + {plus} - {minus} = **{result}**"
+    )
+
+
+def bind_macro(
+    macro_args: List[str],
+    cells: List[AbilityCell],
+    bound_cells: List[BoundCell],
+) -> List[BoundCell]:
+    cells_by_row = {cell[1]: cell for cell in cells}
+    new_bound_cells: List[BoundCell] = []
+    for idx, name in enumerate(macro_args[0::2]):
+        if idx < len(bound_cells):
+            ability_name, row, _ = bound_cells[idx]
+            cell = cells_by_row.get(row)
+            if cell is not None and cell[0] == ability_name and cell[2] is not None:
+                new_bound_cells.append((ability_name, row, cell[2]))
+                continue
+        # Not bound yet or the sheet layout changed, resolve the ability again
+        new_bound_cells.append(resolve_ability(cells, name))
+    return new_bound_cells
+
+
+def bind_macros(
+    macros: Dict[str, Any],
+    character_name: str,
+    cells: List[AbilityCell],
+    bound_at: float,
+) -> Dict[str, str]:
+    # Refresh the bound values of all macros. Macros that do not resolve keep their
+    # expression and stay unbound until they match the sheet again
+    unbound: Dict[str, str] = {}
+    for macro_name, saved_macro in macros["macros"].items():
+        try:
+            saved_macro["cells"] = bind_macro(
+                saved_macro["args"], cells, saved_macro["cells"]
+            )
+            saved_macro.pop("error", None)
+        except CheckExpressionError as e:
+            saved_macro["cells"] = []
+            saved_macro["error"] = str(e)
+            unbound[macro_name] = str(e)
+    macros["sheet_title"] = character_name
+    macros["bound_at"] = bound_at
+    return unbound
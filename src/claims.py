@@ -0,0 +1,114 @@
+# claims.py
+import json
+import os
+from typing import Any, Dict, Optional
+
+import aiofiles
+from dependency_injector.wiring import Provide, inject
+
+from app_config import AppConfigContainer
+
+
+async def make_guild_dir(guild_id: int, claims_dir: str) -> str:
+    guild_dir_path = os.path.join(claims_dir, str(guild_id))
+    # TODO use the below as soon as aiofiles v0.8.0 gets released
+    # await aiofiles.os.makedirs(guild_dir_path, exist_ok=True)
+    # For now use the following workaround to create the dirs
+    try:
+        await aiofiles.os.mkdir(claims_dir)  # type: ignore[attr-defined]
+    except FileExistsError:
+        pass
+    try:
+        await aiofiles.os.mkdir(guild_dir_path)  # type: ignore[attr-defined]
+    except FileExistsError:
+        pass
+    return guild_dir_path
+
+
+@inject
+async def write_claim(
+    guild_id: int,
+    author_id: int,
+    sheet_title: str,
+    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
+) -> None:
+    guild_dir_path = await make_guild_dir(guild_id, claims_dir)
+    # Create the claim file
+    author_file_path = os.path.join(guild_dir_path, str(author_id))
+    async with aiofiles.open(author_file_path, "w") as f:
+        await f.write(sheet_title)
+
+
+@inject
+async def read_claim(
+    guild_id: int,
+    author_id: int,
+    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
+) -> Optional[str]:
+    author_file_path = os.path.join(claims_dir, str(guild_id), str(author_id))
+    try:
+        async with aiofiles.open(author_file_path, "r") as f:
+            sheet_title = await f.read()
+        return sheet_title
+    except FileNotFoundError:
+        return None
+
+
+@inject
+async def write_macros(
+    guild_id: int,
+    author_id: int,
+    macros: Dict[str, Any],
+    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
+) -> None:
+    guild_dir_path = await make_guild_dir(guild_id, claims_dir)
+    # Macros live next to the claim file of the author
+    macros_file_path = os.path.join(guild_dir_path, f"{author_id}.macros.json")
+    async with aiofiles.open(macros_file_path, "w") as f:
+        await f.write(json.dumps(macros))
+
+
+@inject
+async def read_macros(
+    guild_id: int,
+    author_id: int,
+    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
+) -> Optional[Dict[str, Any]]:
+    macros_file_path = os.path.join(
+        claims_dir, str(guild_id), f"{author_id}.macros.json"
+    )
+    try:
+        async with aiofiles.open(macros_file_path, "r") as f:
+            macros: Dict[str, Any] = json.loads(await f.read())
+        return macros
+    except FileNotFoundError:
+        return None
+
+
+# TODO use aiofiles.os.listdir as soon as aiofiles v0.8.0 gets released
+listdir = aiofiles.os.wrap(os.listdir)  # type: ignore[attr-defined]
+
+
+@inject
+async def invalidate_macros(
+    guild_id: int,
+    sheet_title: str,
+    claims_dir: str = Provide[AppConfigContainer.config.db.claims_dir],
+) -> None:
+    # Unset the bound sheet of all macros in the guild bound to sheet_title,
+    # so that the next !m binds them again
+    try:
+        file_names = await listdir(os.path.join(claims_dir, str(guild_id)))
+    except FileNotFoundError:
+        return
+    for file_name in file_names:
+        if not file_name.endswith(".macros.json"):
+            continue
+        author_id_str = file_name[: -len(".macros.json")]
+        if not author_id_str.isdigit():
+            continue
+        author_id = int(author_id_str)
+        macros = await read_macros(guild_id, author_id, claims_dir=claims_dir)
+        if macros is not None and macros["sheet_title"] == sheet_title:
+            macros["sheet_title"] = None
+            await write_macros(guild_id, author_id, macros, claims_dir=claims_dir)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The bot modules live in src/ and are run as scripts, so make them importable
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# app_config reads its settings on import, so provide dummies for the tests
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test")
+os.environ.setdefault("GOOGLE_APPLICATION_CREDENTIALS", "test")
+os.environ.setdefault("CHARACTER_SHEET_HASH", "test")
+os.environ.setdefault("CLAIMS_DIR", "test")
@@ -1,2 +1,393 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+import pytest
+from dependency_injector import providers
+
+import bot
+import claims
+from app_config import AppConfigContainer
+from check_expression import (
+    AbilityCell,
+    CheckExpressionError,
+    bind_macro,
+    bind_macros,
+    build_check_expression,
+    format_check,
+    resolve_ability,
+    split_check_args,
+)
+
+CELLS: List[AbilityCell] = [
+    ("Stärke", 3, 5),
+    ("Stich", 4, 2),
+    ("Geschick", 7, 4),
+    ("schwimmen", 8, 1),
+    ("Schwimmen (Tauchen)", 9, 3),
+]
+
+
 def test_something() -> None:
     pass
+
+
+def test_split_check_args() -> None:
+    assert split_check_args(("Stärke",), "!c Stärke") == (["Stärke"], [])
+    assert split_check_args(("Stärke", "+", "Stich", "-", "Geschick"), "") == (
+        ["Stärke", "Stich", "Geschick"],
+        ["+", "-"],
+    )
+    assert split_check_args((), "!c") == ([], [])
+
+
+def test_split_check_args_invalid_seperator() -> None:
+    with pytest.raises(CheckExpressionError, match=r"\* is an invalid seperator"):
+        split_check_args(("Stärke", "*", "Stich"), "")
+
+
+def test_split_check_args_trailing_seperator() -> None:
+    with pytest.raises(
+        CheckExpressionError, match="expression !c Bob Stärke - ends with a seperator"
+    ):
+        split_check_args(("Stärke", "-"), "!c Bob Stärke -")
+
+
+def test_resolve_ability_exact_case() -> None:
+    # "Schwimmen" matches only one ability as typed, even though two match lowercased
+    assert resolve_ability(CELLS, "Schwimmen") == ("Schwimmen (Tauchen)", 9, 3)
+
+
+def test_resolve_ability_lowercase_fallback() -> None:
+    assert resolve_ability(CELLS, "stär") == ("Stärke", 3, 5)
+
+
+def test_resolve_ability_no_match() -> None:
+    with pytest.raises(CheckExpressionError, match="No ability matches 'Reiten'"):
+        resolve_ability(CELLS, "Reiten")
+
+
+def test_resolve_ability_multiple_matches() -> None:
+    with pytest.raises(CheckExpressionError, match="Multiple abilities"):
+        resolve_ability(CELLS, "St")
+
+
+def test_resolve_ability_row_without_value_is_ambiguous() -> None:
+    # A heading without a value still makes the name ambiguous, just like !check
+    cells: List[AbilityCell] = [("Nahkampf", 11, None), ("Nahkampfwaffen", 12, 4)]
+    with pytest.raises(CheckExpressionError, match="Multiple abilities"):
+        resolve_ability(cells, "Nahkampf")
+
+
+def test_resolve_ability_without_value() -> None:
+    cells: List[AbilityCell] = [("Nahkampf", 11, None), ("Fernkampf", 12, 4)]
+    with pytest.raises(CheckExpressionError, match="'Nahkampf' has no value"):
+        resolve_ability(cells, "Nahk")
+
+
+def test_bind_macro_resolves_unbound() -> None:
+    assert bind_macro(["Geschick", "-", "stär"], CELLS, []) == [
+        ("Geschick", 7, 4),
+        ("Stärke", 3, 5),
+    ]
+
+
+def test_bind_macro_rebinds_by_row() -> None:
+    cells: List[AbilityCell] = [("Stärke", 3, 6), ("Geschick", 7, 2)]
+    # The stored row still holds the bound ability, so only its value is updated
+    bound = bind_macro(
+        ["Ge", "+", "Stä"], cells, [("Geschick", 7, 4), ("Stärke", 3, 5)]
+    )
+    assert bound == [("Geschick", 7, 2), ("Stärke", 3, 6)]
+
+
+def test_bind_macro_resolves_again_on_name_mismatch() -> None:
+    # Abilities moved rows, so they are resolved again from the macro arguments
+    cells: List[AbilityCell] = [("Geschick", 3, 1), ("Stärke", 7, 6)]
+    bound = bind_macro(
+        ["Ge", "+", "Stä"], cells, [("Geschick", 7, 4), ("Stärke", 3, 5)]
+    )
+    assert bound == [("Geschick", 3, 1), ("Stärke", 7, 6)]
+
+
+def test_bind_macro_bound_row_lost_value() -> None:
+    cells: List[AbilityCell] = [("Geschick", 7, None)]
+    with pytest.raises(CheckExpressionError, match="'Geschick' has no value"):
+        bind_macro(["Ge"], cells, [("Geschick", 7, 4)])
+
+
+def test_bind_macro_unresolvable() -> None:
+    with pytest.raises(CheckExpressionError, match="No ability matches 'Ge'"):
+        bind_macro(["Ge"], [("Stärke", 3, 5)], [("Geschick", 7, 4)])
+
+
+def test_build_check_expression() -> None:
+    assert build_check_expression([("Stärke", 5)], []) == [("Stärke", 5)]
+    assert build_check_expression([("Stärke", 5), ("Stich", 2)], ["-"]) == [
+        ("Stärke", 5),
+        "-",
+        ("Stich", 2),
+    ]
+
+
+def test_format_check_single_ability(monkeypatch: pytest.MonkeyPatch) -> None:
+    rolls = iter([3, 1])
+    monkeypatch.setattr(np.random, "randint", lambda low, high: next(rolls))
+    assert format_check("Bob", [("Stärke", 5)]) == (
+        "**Bob** rolls 2 x Stärke + d4 - d4 = 10 + 3 - 1 = **12**"
+    )
+
+
+def test_format_check_expression(monkeypatch: pytest.MonkeyPatch) -> None:
+    rolls = iter([2, 4])
+    monkeypatch.setattr(np.random, "randint", lambda low, high: next(rolls))
+    expression = build_check_expression([("Stärke", 5), ("Stich", 2)], ["-"])
+    assert format_check("Bob", expression) == (
+        "**Bob** rolls Stärke - Stich + d4 - d4 = 5 - 2 + 2 - 4 = **1**"
+    )
+
+
+class FakeAiogoogle:
+    async def __aenter__(self) -> "FakeAiogoogle":
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    async def discover(self, api_name: str, api_version: str) -> None:
+        return None
+
+
+class FakeContext:
+    def __init__(self, content: str, guild_id: int = 1, author_id: int = 2) -> None:
+        self.message = SimpleNamespace(
+            content=content,
+            guild=SimpleNamespace(id=guild_id),
+            author=SimpleNamespace(id=author_id),
+        )
+        self.sent: List[str] = []
+
+    async def send(self, message: str) -> None:
+        self.sent.append(message)
+
+
+@pytest.fixture
+def claims_dir(tmp_path: Any) -> Iterator[str]:
+    container = AppConfigContainer()
+    container.config.db.claims_dir.override(str(tmp_path))
+    container.aiog.override(providers.Object(FakeAiogoogle()))
+    container.wire(modules=[bot, claims])
+    yield str(tmp_path)
+    container.unwire()
+
+
+@pytest.fixture
+def sheet_cells(monkeypatch: pytest.MonkeyPatch) -> Dict[str, List[AbilityCell]]:
+    # Stand-in for the character sheet document, keyed by sheet title
+    sheets: Dict[str, List[AbilityCell]] = {}
+
+    async def get_ability_cells(
+        aiog: Any, sheets_service: Any, doc_id: str, sheet_title: str
+    ) -> List[AbilityCell]:
+        if sheet_title not in sheets:
+            raise bot.SheetNotFoundError(sheet_title)
+        return sheets[sheet_title]
+
+    async def get_sheets_properties(
+        aiog: Any, sheets_service: Any, doc_id: str
+    ) -> List[Dict[str, Any]]:
+        return [{"title": sheet_title} for sheet_title in sheets]
+
+    monkeypatch.setattr(bot, "get_ability_cells", get_ability_cells)
+    monkeypatch.setattr(bot, "get_sheets_properties", get_sheets_properties)
+    monkeypatch.setattr(np.random, "randint", lambda low, high: 1)
+    return sheets
+
+
+def test_bind_macros_keeps_unbound() -> None:
+    macros: Dict[str, Any] = {
+        "sheet_title": "Bob",
+        "macros": {
+            "a": {"args": ["Stärke"], "cells": []},
+            "b": {"args": ["Reiten"], "cells": []},
+        },
+    }
+    unbound = bind_macros(macros, "Al", [("Stärke", 3, 5)], 10.0)
+    assert list(unbound.keys()) == ["b"]
+    assert macros["sheet_title"] == "Al"
+    assert macros["bound_at"] == 10.0
+    assert macros["macros"]["a"]["cells"] == [("Stärke", 3, 5)]
+    assert macros["macros"]["b"] == {
+        "args": ["Reiten"],
+        "cells": [],
+        "error": "ERROR: No ability matches 'Reiten'",
+    }
+
+    # The macro is restored as soon as it matches the sheet again
+    unbound = bind_macros(macros, "Bob", [("Stärke", 3, 5), ("Reiten", 4, 1)], 20.0)
+    assert unbound == {}
+    assert macros["macros"]["b"] == {"args": ["Reiten"], "cells": [("Reiten", 4, 1)]}
+
+
+def test_macros_json_round_trip(claims_dir: str) -> None:
+    macros: Dict[str, Any] = {
+        "sheet_title": "Bob",
+        "macros": {"a": {"args": ["Ge", "+", "Stä"], "cells": []}},
+    }
+    bind_macros(macros, "Bob", CELLS, 10.0)
+    asyncio.run(claims.write_macros(1, 2, macros))
+    stored = asyncio.run(claims.read_macros(1, 2))
+    assert stored is not None
+    # Tuples come back as lists from storage, rebinding by row still works
+    assert stored["macros"]["a"]["cells"] == [["Geschick", 7, 4], ["Stärke", 3, 5]]
+    assert bind_macro(
+        stored["macros"]["a"]["args"], CELLS, stored["macros"]["a"]["cells"]
+    ) == [
+        ("Geschick", 7, 4),
+        ("Stärke", 3, 5),
+    ]
+    assert asyncio.run(claims.read_macros(1, 3)) is None
+
+
+def test_rebind_macros(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    sheet_cells["Bob"] = [("Stärke", 3, 5)]
+    macros: Dict[str, Any] = {
+        "sheet_title": "Al",
+        "macros": {
+            "a": {"args": ["Stärke"], "cells": []},
+            "b": {"args": ["Reiten"], "cells": []},
+        },
+    }
+    unbound = asyncio.run(bot.rebind_macros("Bob", macros))
+    assert list(unbound.keys()) == ["b"]
+    assert macros["sheet_title"] == "Bob"
+    assert "b" in macros["macros"]
+
+
+def test_macro_save_and_run(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    sheet_cells["Bob"] = CELLS
+    asyncio.run(claims.write_claim(1, 2, "Bob"))
+    ctx = FakeContext("!macro save a Ge + Stä")
+    asyncio.run(bot.macro.callback(ctx, "save", "a", "Ge", "+", "Stä"))
+    assert len(ctx.sent) == 1 and ctx.sent[0].endswith("saved macro 'a'")
+
+    # Running the macro does not read the sheet anymore
+    del sheet_cells["Bob"]
+    ctx = FakeContext("!m a")
+    asyncio.run(bot.run_macro.callback(ctx, "a"))
+    assert ctx.sent == [
+        "**Bob** rolls Geschick + Stärke + d4 - d4 = 4 + 5 + 1 - 1 = **9**"
+    ]
+
+
+def test_macro_save_invalid(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    sheet_cells["Bob"] = CELLS
+    asyncio.run(claims.write_claim(1, 2, "Bob"))
+    ctx = FakeContext("!macro save a St")
+    asyncio.run(bot.macro.callback(ctx, "save", "a", "St"))
+    assert ctx.sent[0].startswith("ERROR: Multiple abilities")
+    assert asyncio.run(claims.read_macros(1, 2)) is None
+
+
+def test_run_macro_rebinds_on_claim_change(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    sheet_cells["Al"] = [("Stärke", 3, 2)]
+    asyncio.run(claims.write_claim(1, 2, "Al"))
+    macros: Dict[str, Any] = {
+        "sheet_title": "Bob",
+        "bound_at": 0.0,
+        "macros": {
+            "a": {"args": ["Stärke"], "cells": [["Stärke", 3, 5]]},
+            "b": {"args": ["Geschick"], "cells": [["Geschick", 7, 4]]},
+        },
+    }
+    asyncio.run(claims.write_macros(1, 2, macros))
+
+    ctx = FakeContext("!m a")
+    asyncio.run(bot.run_macro.callback(ctx, "a"))
+    assert len(ctx.sent) == 1
+    roll, warning = ctx.sent[0].split("\n")
+    assert roll == "**Al** rolls 2 x Stärke + d4 - d4 = 4 + 1 - 1 = **4**"
+    assert warning.startswith("WARNING: Macros ['b'] do not match")
+
+    stored = asyncio.run(claims.read_macros(1, 2))
+    assert stored is not None
+    assert stored["sheet_title"] == "Al"
+    assert stored["macros"]["b"]["error"] == "ERROR: No ability matches 'Geschick'"
+
+    # The unbound macro answers with its error without reading the sheet again
+    del sheet_cells["Al"]
+    ctx = FakeContext("!m b")
+    asyncio.run(bot.run_macro.callback(ctx, "b"))
+    assert ctx.sent == ["ERROR: No ability matches 'Geschick'"]
+
+
+def test_run_macro_stale_note(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    asyncio.run(claims.write_claim(1, 2, "Bob"))
+    macros: Dict[str, Any] = {
+        "sheet_title": "Bob",
+        "bound_at": 0.0,
+        "macros": {"a": {"args": ["Stärke"], "cells": [["Stärke", 3, 5]]}},
+    }
+    asyncio.run(claims.write_macros(1, 2, macros))
+    ctx = FakeContext("!m a")
+    asyncio.run(bot.run_macro.callback(ctx, "a"))
+    assert "NOTE: These values were read from your sheet more than" in ctx.sent[0]
+
+
+def test_invalidate_macros(claims_dir: str) -> None:
+    bound: Dict[str, Any] = {"sheet_title": "Bob", "macros": {}}
+    asyncio.run(claims.write_macros(1, 2, bound))
+    asyncio.run(claims.write_macros(1, 3, {"sheet_title": "Al", "macros": {}}))
+    asyncio.run(claims.write_macros(5, 2, bound))
+    # Unexpected entries in the claims dir are skipped
+    with open(os.path.join(claims_dir, "1", "notes.macros.json"), "w") as f:
+        f.write("not json")
+    os.mkdir(os.path.join(claims_dir, "1", "archive"))
+
+    asyncio.run(claims.invalidate_macros(1, "Bob"))
+    asyncio.run(claims.invalidate_macros(7, "Bob"))
+
+    def sheet_title(guild_id: int, author_id: int) -> Any:
+        with open(
+            os.path.join(claims_dir, str(guild_id), f"{author_id}.macros.json")
+        ) as f:
+            return json.load(f)["sheet_title"]
+
+    assert sheet_title(1, 2) is None
+    assert sheet_title(1, 3) == "Al"
+    # Other guilds are left alone
+    assert sheet_title(5, 2) == "Bob"
+
+
+def test_check_refreshes_claimed_macros(
+    claims_dir: str, sheet_cells: Dict[str, List[AbilityCell]]
+) -> None:
+    sheet_cells["Bob"] = [("Stärke", 3, 6)]
+    asyncio.run(claims.write_claim(1, 2, "Bob"))
+    macros: Dict[str, Any] = {
+        "sheet_title": "Bob",
+        "bound_at": 0.0,
+        "macros": {"a": {"args": ["Stärke"], "cells": [["Stärke", 3, 5]]}},
+    }
+    asyncio.run(claims.write_macros(1, 2, macros))
+
+    ctx = FakeContext("!check Stärke")
+    asyncio.run(bot.check_impl(ctx, "Bob", "Stärke"))
+    assert ctx.sent == ["**Bob** rolls 2 x Stärke + d4 - d4 = 12 + 1 - 1 = **12**"]
+    stored = asyncio.run(claims.read_macros(1, 2))
+    assert stored is not None
+    assert stored["macros"]["a"]["cells"] == [["Stärke", 3, 6]]
+    assert stored["bound_at"] > 0.0